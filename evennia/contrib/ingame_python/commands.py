@@ -3,6 +3,8 @@ Module containing the commands of the in-game Python system.
 """
 
 from datetime import datetime
+from heapq import merge
+import time
 
 from django.conf import settings
 from evennia import Command
@@ -10,6 +12,7 @@ from evennia.utils.ansi import raw
 from evennia.utils.eveditor import EvEditor
 from evennia.utils.evtable import EvTable
 from evennia.utils.utils import class_from_module, time_format
+from evennia.contrib.ingame_python.callbackhandler import CallbackHandler
 from evennia.contrib.ingame_python.utils import get_event_handler
 
 COMMAND_DEFAULT_CLASS = class_from_module(settings.COMMAND_DEFAULT_CLASS)
@@ -18,28 +21,41 @@ COMMAND_DEFAULT_CLASS = class_from_module(settings.COMMAND_DEFAULT_CLASS)
 WITH_VALIDATION = getattr(settings, "callbackS_WITH_VALIDATION", None)
 WITHOUT_VALIDATION = getattr(settings, "callbackS_WITHOUT_VALIDATION", "developer")
 VALIDATING = getattr(settings, "callbackS_VALIDATING", "developer")
+_VALIDATOR_LOCK = "perm({}) or perm(events_validating)".format(VALIDATING)
+_AUTOVALID_LOCK = "perm({}) or perm(events_without_validation)".format(WITHOUT_VALIDATION)
 
-# Split help text
-BASIC_HELP = "Add, edit or delete callbacks."
-
-BASIC_USAGES = [
-    "@call <object name> [= <callback name>]",
-    "@call/add <object name> = <callback name> [parameters]",
-    "@call/edit <object name> = <callback name> [callback number]",
-    "@call/del <object name> = <callback name> [callback number]",
-    "@call/tasks [object name [= <callback name>]]",
-]
+# Number of seconds a permission check is kept in the caller's cache
+PERM_CACHE_TTL = 20
+PERM_CACHE_SAVE_TTL = 5
 
-BASIC_SWITCHES = [
-    "add    - add and edit a new callback",
-    "edit   - edit an existing callback",
-    "del    - delete an existing callback",
-    "tasks  - show the list of differed tasks",
-]
+# Keys an edited callback must have to be saved
+_REQUIRED_CALLBACK_KEYS = frozenset(("obj", "name", "number", "valid"))
 
-VALIDATOR_USAGES = ["@call/accept [object name = <callback name> [callback number]]"]
+# Split help text
+BASIC_HELP = "Add, edit or delete callbacks."
 
-VALIDATOR_SWITCHES = ["accept - show callbacks to be validated or accept one"]
+BASIC_USAGES = "\n  ".join(
+    [
+        "@call <object name> [= <callback name>]",
+        "@call/add <object name> = <callback name> [parameters]",
+        "@call/edit <object name> = <callback name> [callback number]",
+        "@call/del <object name> = <callback name> [callback number]",
+        "@call/tasks [object name [= <callback name>]]",
+    ]
+)
+
+BASIC_SWITCHES = "\n  ".join(
+    [
+        "add    - add and edit a new callback",
+        "edit   - edit an existing callback",
+        "del    - delete an existing callback",
+        "tasks  - show the list of differed tasks",
+    ]
+)
+
+VALIDATOR_USAGES = "@call/accept [object name = <callback name> [callback number]]"
+
+VALIDATOR_SWITCHES = "accept - show callbacks to be validated or accept one"
 
 BASIC_TEXT = """
 This command is used to manipulate callbacks.  A callback can be linked to
@@ -68,6 +84,34 @@ them and when.  You can then accept a specific callback:
 Use the /del switch to remove callbacks that should not be connected.
 """
 
+# Full help texts, indexed by whether the caller is a validator
+_HELP_BASIC = (
+    "\n"
+    + BASIC_HELP
+    + "\n\nUsages:\n  "
+    + BASIC_USAGES
+    + "\n\nSwitches:\n  "
+    + BASIC_SWITCHES
+    + "\n"
+    + BASIC_TEXT
+)
+_HELP_VALIDATOR = (
+    "\n"
+    + BASIC_HELP
+    + "\n\nUsages:\n  "
+    + BASIC_USAGES
+    + "\n  "
+    + VALIDATOR_USAGES
+    + "\n\nSwitches:\n  "
+    + BASIC_SWITCHES
+    + "\n  "
+    + VALIDATOR_SWITCHES
+    + "\n"
+    + BASIC_TEXT
+    + "\n"
+    + VALIDATOR_TEXT
+)
+
 
 class CmdCallback(COMMAND_DEFAULT_CLASS):
 
@@ -81,6 +125,18 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
     if WITH_VALIDATION:
         locks += " or perm({})".format(WITH_VALIDATION)
     help_category = "Building"
+    _HELP_TEXTS = (_HELP_BASIC, _HELP_VALIDATOR)
+
+    # Switch: (needs an object, method name)
+    _DISPATCH = {
+        "": (True, "list_callbacks"),
+        "add": (True, "add_callback"),
+        "edit": (True, "edit_callback"),
+        "del": (True, "del_callback"),
+        "accept": (False, "accept_callback"),
+        "tasks": (False, "list_tasks"),
+        "task": (False, "list_tasks"),
+    }
 
     def get_help(self, caller, cmdset):
         """
@@ -97,38 +153,17 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
             docstring (str): the help text to provide the caller for this command.
 
         """
-        lock = "perm({}) or perm(callbacks_validating)".format(VALIDATING)
-        validator = caller.locks.check_lockstring(caller, lock)
-        text = "\n" + BASIC_HELP + "\n\nUsages:\n  "
-
-        # Usages
-        text += "\n  ".join(BASIC_USAGES)
-        if validator:
-            text += "\n  " + "\n  ".join(VALIDATOR_USAGES)
-
-        # Switches
-        text += "\n\nSwitches:\n  "
-        text += "\n  ".join(BASIC_SWITCHES)
-        if validator:
-            text += "\n  " + "\n  ".join(VALIDATOR_SWITCHES)
-
-        # Text
-        text += "\n" + BASIC_TEXT
-        if validator:
-            text += "\n" + VALIDATOR_TEXT
-
-        return text
+        validator = _cached_check(caller, _VALIDATOR_LOCK)
+        return self._HELP_TEXTS[bool(validator)]
 
     def func(self):
         """Command body."""
         caller = self.caller
-        lock = "perm({}) or perm(events_validating)".format(VALIDATING)
-        validator = caller.locks.check_lockstring(caller, lock)
-        lock = "perm({}) or perm(events_without_validation)".format(WITHOUT_VALIDATION)
-        autovalid = caller.locks.check_lockstring(caller, lock)
+        validator = _cached_check(caller, _VALIDATOR_LOCK)
+        autovalid = _cached_check(caller, _AUTOVALID_LOCK)
 
         # First and foremost, get the callback handler and set other variables
-        self.handler = get_event_handler()
+        self.handler = _handler()
         self.obj = None
         rhs = self.rhs or ""
         self.callback_name, sep, self.parameters = rhs.partition(" ")
@@ -147,24 +182,17 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
 
         # Switches are mutually exclusive
         switch = self.switches and self.switches[0] or ""
-        if switch in ("", "add", "edit", "del") and self.obj is None:
+        entry = self._DISPATCH.get(switch)
+        if entry is None or (switch == "accept" and not validator):
+            caller.msg("Mutually exclusive or invalid switches were " "used, cannot proceed.")
+            return
+
+        needs_obj, method = entry
+        if needs_obj and self.obj is None:
             caller.msg("Specify an object's name or #ID.")
             return
 
-        if switch == "":
-            self.list_callbacks()
-        elif switch == "add":
-            self.add_callback()
-        elif switch == "edit":
-            self.edit_callback()
-        elif switch == "del":
-            self.del_callback()
-        elif switch == "accept" and validator:
-            self.accept_callback()
-        elif switch in ["tasks", "task"]:
-            self.list_tasks()
-        else:
-            caller.msg("Mutually exclusive or invalid switches were " "used, cannot proceed.")
+        getattr(self, method)()
 
     def list_callbacks(self):
         """Display the list of callbacks connected to the object."""
@@ -178,7 +206,7 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
             # Check that the callback name can be found in this object
             created = callbacks.get(callback_name)
             if created is None:
-                self.msg("No callback {} has been set on {}.".format(callback_name, obj))
+                self.msg(f"No callback {callback_name} has been set on {obj}.")
                 return
 
             if parameters:
@@ -188,11 +216,7 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
                     assert number >= 0
                     callback = callbacks[callback_name][number]
                 except (ValueError, AssertionError, IndexError):
-                    self.msg(
-                        "The callback {} {} cannot be found in {}.".format(
-                            callback_name, parameters, obj
-                        )
-                    )
+                    self.msg(f"The callback {callback_name} {parameters} cannot be found in {obj}.")
                     return
 
                 # Display the callback's details
@@ -208,9 +232,9 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
                 updated_on = (
                     updated_on.strftime("%Y-%m-%d %H:%M:%S") if updated_on else "|gUnknown|n"
                 )
-                msg = "Callback {} {} of {}:".format(callback_name, parameters, obj)
-                msg += "\nCreated by {} on {}.".format(author, created_on)
-                msg += "\nUpdated by {} on {}".format(updated_by, updated_on)
+                msg = f"Callback {callback_name} {parameters} of {obj}:"
+                msg += f"\nCreated by {author} on {created_on}."
+                msg += f"\nUpdated by {updated_by} on {updated_on}"
 
                 if self.is_validator:
                     if callback.get("valid"):
@@ -228,20 +252,15 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
             if self.is_validator:
                 cols.append("Valid")
 
-            table = EvTable(*cols, width=78)
-            table.reformat_column(0, align="r")
-            now = datetime.now()
+            rows = []
+            now_ts = datetime.now().timestamp()
             for i, callback in enumerate(created):
                 author = callback.get("author")
                 author = author.key if author else "|gUnknown|n"
-                updated_on = callback.get("updated_on")
-                if updated_on is None:
-                    updated_on = callback.get("created_on")
-
+                updated_on = callback.get("updated_on") or callback.get("created_on")
                 if updated_on:
-                    updated_on = "{} ago".format(
-                        time_format((now - updated_on).total_seconds(), 4).capitalize()
-                    )
+                    delta = now_ts - updated_on.timestamp()
+                    updated_on = f"{time_format(delta, 4).capitalize()} ago"
                 else:
                     updated_on = "|gUnknown|n"
                 parameters = callback.get("parameters", "")
@@ -249,23 +268,40 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
                 row = [str(i + 1), author, updated_on, parameters]
                 if self.is_validator:
                     row.append("Yes" if callback.get("valid") else "No")
-                table.add_row(*row)
+                rows.append(row)
 
+            # Build the table from whole columns at once
+            table = EvTable(*cols, table=[list(col) for col in zip(*rows)], width=78)
+            table.reformat_column(0, align="r")
             self.msg(str(table))
         else:
-            names = list(set(list(types.keys()) + list(callbacks.keys())))
-            table = EvTable("Callback name", "Number", "Description", valign="t", width=78)
+            # Event names are sorted once per typeclass, callbacks without
+            # an event (like chained ones) are merged in
+            extra = sorted(name for name in callbacks if name not in types)
+            rows = []
+            for name in merge(self.handler.get_sorted_event_names(obj), extra):
+                callback_list = callbacks.get(name, ())
+                number = len(callback_list)
+                lines = sum(
+                    e["code"].count("\n") + (1 if e["code"] and not e["code"].endswith("\n") else 0)
+                    for e in callback_list
+                )
+                no = f"{number} ({lines})"
+                description = types.get(name, (None, "Chained event."))[1]
+                description = description.strip("\n").partition("\n")[0]
+                rows.append((name, no, description))
+
+            table = EvTable(
+                "Callback name",
+                "Number",
+                "Description",
+                table=[list(col) for col in zip(*rows)],
+                valign="t",
+                width=78,
+            )
             table.reformat_column(0, width=20)
             table.reformat_column(1, width=10, align="r")
             table.reformat_column(2, width=48)
-            for name in sorted(names):
-                number = len(callbacks.get(name, []))
-                lines = sum(len(e["code"].splitlines()) for e in callbacks.get(name, []))
-                no = "{} ({})".format(number, lines)
-                description = types.get(name, (None, "Chained event."))[1]
-                description = description.strip("\n").splitlines()[0]
-                table.add_row(name, no, description)
-
             self.msg(str(table))
 
     def add_callback(self):
@@ -277,16 +313,12 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
         # Check that the callback exists
         if not callback_name.startswith("chain_") and callback_name not in types:
             self.msg(
-                "The callback name {} can't be found in {} of "
-                "typeclass {}.".format(callback_name, obj, type(obj))
+                f"The callback name {callback_name} can't be found in {obj} of "
+                f"typeclass {obj.__class__.__name__}."
             )
             return
 
         definition = types.get(callback_name, (None, "Chained event."))
-        description = definition[1]
-        self.msg(raw(description.strip("\n")))
-
-        # Open the editor
         callback = self.handler.add_callback(
             obj, callback_name, "", self.caller, False, parameters=self.parameters
         )
@@ -295,16 +327,7 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
         self.handler.db.locked.append((obj, callback_name, callback["number"]))
 
         # Open the editor for this callback
-        self.caller.db._callback = callback
-        EvEditor(
-            self.caller,
-            loadfunc=_ev_load,
-            savefunc=_ev_save,
-            quitfunc=_ev_quit,
-            key="Callback {} of {}".format(callback_name, obj),
-            persistent=True,
-            codefunc=_ev_save,
-        )
+        self._open_editor(callback, definition[1])
 
     def edit_callback(self):
         """Edit a callback."""
@@ -321,7 +344,7 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
 
         # Check that the callback exists
         if callback_name not in callbacks:
-            self.msg("The callback name {} can't be found in {}.".format(callback_name, obj))
+            self.msg(f"The callback name {callback_name} can't be found in {obj}.")
             return
 
         # If there's only one callback, just edit it
@@ -340,11 +363,7 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
                 assert number >= 0
                 callback = callbacks[callback_name][number]
             except (ValueError, AssertionError, IndexError):
-                self.msg(
-                    "The callback {} {} cannot be found in {}.".format(
-                        callback_name, parameters, obj
-                    )
-                )
+                self.msg(f"The callback {callback_name} {parameters} cannot be found in {obj}.")
                 return
 
         # If caller can't edit without validation, forbid editing
@@ -360,23 +379,23 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
 
         self.handler.db.locked.append((obj, callback_name, number))
 
-        # Check the definition of the callback
+        # Open the editor with the definition of the callback
         definition = types.get(callback_name, (None, "Chained event."))
-        description = definition[1]
-        self.msg(raw(description.strip("\n")))
+        self._open_editor(dict(callback), definition[1])
+
+    def _open_editor(self, callback, description):
+        """
+        Open the code editor on a callback.
+
+        Args:
+            callback (dict): the callback to edit, with at least its
+                `obj` and `name` keys.
+            description (str): the help text of the callback's event.
 
-        # Open the editor
-        callback = dict(callback)
+        """
+        self.msg(raw(description.strip("\n")))
         self.caller.db._callback = callback
-        EvEditor(
-            self.caller,
-            loadfunc=_ev_load,
-            savefunc=_ev_save,
-            quitfunc=_ev_quit,
-            key="Callback {} of {}".format(callback_name, obj),
-            persistent=True,
-            codefunc=_ev_save,
-        )
+        EvEditor(self.caller, key=f"Callback {callback['name']} of {callback['obj']}", **_EDITOR_KW)
 
     def del_callback(self):
         """Delete a callback."""
@@ -384,7 +403,6 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
         callback_name = self.callback_name
         parameters = self.parameters
         callbacks = self.handler.get_callbacks(obj)
-        types = self.handler.get_events(obj)
 
         # If no callback name is specified, display the list of callbacks
         if not callback_name:
@@ -393,7 +411,7 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
 
         # Check that the callback exists
         if callback_name not in callbacks:
-            self.msg("The callback name {} can't be found in {}.".format(callback_name, obj))
+            self.msg(f"The callback name {callback_name} can't be found in {obj}.")
             return
 
         # If there's only one callback, just delete it
@@ -412,11 +430,7 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
                 assert number >= 0
                 callback = callbacks[callback_name][number]
             except (ValueError, AssertionError, IndexError):
-                self.msg(
-                    "The callback {} {} cannot be found in {}.".format(
-                        callback_name, parameters, obj
-                    )
-                )
+                self.msg(f"The callback {callback_name} {parameters} cannot be found in {obj}.")
                 return
 
         # If caller can't edit without validation, forbid deleting
@@ -432,7 +446,7 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
 
         # Delete the callback
         self.handler.del_callback(obj, callback_name, number)
-        self.msg("The callback {}[{}] of {} was deleted.".format(callback_name, number + 1, obj))
+        self.msg(f"The callback {callback_name}[{number + 1}] of {obj} was deleted.")
 
     def accept_callback(self):
         """Accept a callback."""
@@ -444,7 +458,7 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
         if obj is None:
             table = EvTable("ID", "Type", "Object", "Name", "Updated by", "On", width=78)
             table.reformat_column(0, align="r")
-            now = datetime.now()
+            now_ts = datetime.now().timestamp()
             for obj, name, number in self.handler.db.to_valid:
                 callbacks = self.handler.get_callbacks(obj).get(name)
                 if callbacks is None:
@@ -458,14 +472,10 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
                 type_name = obj.typeclass_path.split(".")[-1]
                 by = callback.get("updated_by")
                 by = by.key if by else "|gUnknown|n"
-                updated_on = callback.get("updated_on")
-                if updated_on is None:
-                    updated_on = callback.get("created_on")
-
+                updated_on = callback.get("updated_on") or callback.get("created_on")
                 if updated_on:
-                    updated_on = "{} ago".format(
-                        time_format((now - updated_on).total_seconds(), 4).capitalize()
-                    )
+                    delta = now_ts - updated_on.timestamp()
+                    updated_on = f"{time_format(delta, 4).capitalize()} ago"
                 else:
                     updated_on = "|gUnknown|n"
 
@@ -475,7 +485,6 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
 
         # An object was specified
         callbacks = self.handler.get_callbacks(obj)
-        types = self.handler.get_events(obj)
 
         # If no callback name is specified, display the list of callbacks
         if not callback_name:
@@ -484,7 +493,7 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
 
         # Check that the callback exists
         if callback_name not in callbacks:
-            self.msg("The callback name {} can't be found in {}.".format(callback_name, obj))
+            self.msg(f"The callback name {callback_name} can't be found in {obj}.")
             return
 
         if not parameters:
@@ -498,9 +507,7 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
             assert number >= 0
             callback = callbacks[callback_name][number]
         except (ValueError, AssertionError, IndexError):
-            self.msg(
-                "The callback {} {} cannot be found in {}.".format(callback_name, parameters, obj)
-            )
+            self.msg(f"The callback {callback_name} {parameters} cannot be found in {obj}.")
             return
 
         # Accept the callback
@@ -508,9 +515,7 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
             self.msg("This callback has already been accepted.")
         else:
             self.handler.accept_callback(obj, callback_name, number)
-            self.msg(
-                "The callback {} {} of {} has been accepted.".format(callback_name, parameters, obj)
-            )
+            self.msg(f"The callback {callback_name} {parameters} of {obj} has been accepted.")
 
     def list_tasks(self):
         """List the active tasks."""
@@ -538,21 +543,71 @@ class CmdCallback(COMMAND_DEFAULT_CLASS):
 # Private functions to handle editing
 
 
+def _handler():
+    """
+    Return the event handler or None.
+
+    The handler placed in the CallbackHandler when it started is used
+    if it still exists, the database is only queried otherwise.
+
+    """
+    handler = CallbackHandler.script
+    if handler is None or handler.pk is None:
+        handler = get_event_handler()
+
+    return handler
+
+
+def _cached_check(caller, lock, ttl=PERM_CACHE_TTL):
+    """
+    Check a lockstring on the caller, caching the result for a while.
+
+    Args:
+        caller (Object or Account): the caller to check.
+        lock (str): the lockstring to check.
+        ttl (int, optional): maximum age, in seconds, of a cached result.
+
+    Returns:
+        result (bool): whether the caller passes the lock.
+
+    Notes:
+        Permission checks on a puppet use the permissions of its account,
+        so results are cached per account and quell state: another account
+        puppeting the same object, or quelling, gets a fresh check.
+        Use a short `ttl` on write paths so revoked permissions
+        take effect quickly.
+
+    """
+    cache = caller.ndb._callback_perm_cache
+    if cache is None:
+        cache = caller.ndb._callback_perm_cache = {}
+
+    account = getattr(caller, "account", None)
+    if account:
+        key = (account.id, bool(account.attributes.get("_quell")), lock)
+    else:
+        key = (None, False, lock)
+
+    now = time.time()
+    result, checked_on = cache.get(key, (None, None))
+    if checked_on is None or now - checked_on >= ttl:
+        result = caller.locks.check_lockstring(caller, lock)
+        cache[key] = (result, now)
+
+    return result
+
+
 def _ev_load(caller):
-    return caller.db._callback and caller.db._callback.get("code", "") or ""
+    callback = caller.db._callback
+    return callback.get("code", "") if callback else ""
 
 
 def _ev_save(caller, buf):
     """Save and add the callback."""
-    lock = "perm({}) or perm(events_without_validation)".format(WITHOUT_VALIDATION)
-    autovalid = caller.locks.check_lockstring(caller, lock)
+    autovalid = _cached_check(caller, _AUTOVALID_LOCK, ttl=PERM_CACHE_SAVE_TTL)
     callback = caller.db._callback
-    handler = get_event_handler()
-    if (
-        not handler
-        or not callback
-        or not all(key in callback for key in ("obj", "name", "number", "valid"))
-    ):
+    handler = _handler()
+    if not handler or not callback or not _REQUIRED_CALLBACK_KEYS.issubset(callback):
         caller.msg("Couldn't save this callback.")
         return False
 
@@ -567,12 +622,8 @@ def _ev_save(caller, buf):
 
 def _ev_quit(caller):
     callback = caller.db._callback
-    handler = get_event_handler()
-    if (
-        not handler
-        or not callback
-        or not all(key in callback for key in ("obj", "name", "number", "valid"))
-    ):
+    handler = _handler()
+    if not handler or not callback or not _REQUIRED_CALLBACK_KEYS.issubset(callback):
         caller.msg("Couldn't save this callback.")
         return False
 
@@ -581,3 +632,9 @@ def _ev_quit(caller):
 
     del caller.db._callback
     caller.msg("Exited the code editor.")
+
+
+# Static keywords of the code editor
+_EDITOR_KW = dict(
+    loadfunc=_ev_load, savefunc=_ev_save, quitfunc=_ev_quit, persistent=True, codefunc=_ev_save
+)
@@ -63,6 +63,7 @@ class EventHandler(DefaultScript):
 
         """
         self.ndb.events = {}
+        self.ndb.sorted_events = {}
         for typeclass, name, variables, help_text, custom_call, custom_add in EVENTS:
             self.add_event(typeclass, name, variables, help_text, custom_call, custom_add)
 
@@ -148,6 +149,33 @@ class EventHandler(DefaultScript):
 
         return events
 
+    def get_sorted_event_names(self, obj):
+        """
+        Return the sorted names of the events on this object.
+
+        Args:
+            obj (Object or typeclass): the connected object or a general typeclass.
+
+        Returns:
+            names (tuple of str): the names of the events returned by
+                `get_events`, sorted alphabetically.
+
+        Notes:
+            The sorted names are cached per typeclass, since events only
+            change when they are added.  The cache is cleared by `add_event`.
+
+        """
+        typeclass = obj if isinstance(obj, type) else type(obj)
+        if self.ndb.sorted_events is None:
+            self.ndb.sorted_events = {}
+
+        names = self.ndb.sorted_events.get(typeclass)
+        if names is None:
+            names = tuple(sorted(self.get_events(typeclass)))
+            self.ndb.sorted_events[typeclass] = names
+
+        return names
+
     def get_variable(self, variable_name):
         """
         Return the variable defined in the locals.
@@ -548,6 +576,7 @@ class EventHandler(DefaultScript):
         events = self.ndb.events[typeclass]
         if name not in events:
             events[name] = (variables, help_text, custom_call, custom_add)
+            self.ndb.sorted_events = {}
 
     def set_task(self, seconds, obj, callback_name):
         """
@@ -2,7 +2,7 @@
 Module containing the test cases for the in-game Python system.
 """
 
-from mock import Mock
+from mock import Mock, patch
 from textwrap import dedent
 
 from django.conf import settings
@@ -13,6 +13,7 @@ from evennia.utils import ansi, utils
 from evennia.utils.create import create_object, create_script
 from evennia.utils.test_resources import EvenniaTest
 from evennia.contrib.ingame_python.commands import CmdCallback
+from evennia.contrib.ingame_python.commands import _cached_check, _VALIDATOR_LOCK, PERM_CACHE_TTL
 from evennia.contrib.ingame_python.callbackhandler import CallbackHandler
 
 # Force settings
@@ -60,6 +61,24 @@ class TestEventHandler(EvenniaTest):
         self.assertEqual(self.handler.db.tasks, {})
         self.assertIsNotNone(self.handler.ndb.events)
 
+    def test_sorted_event_names(self):
+        """Get the cached, sorted event names of an object."""
+        names = self.handler.get_sorted_event_names(self.room1)
+        self.assertEqual(names, tuple(sorted(self.handler.get_events(self.room1))))
+        self.assertIs(self.handler.get_sorted_event_names(self.room1), names)
+
+        # Adding an event should clear the cache
+        path = "evennia.contrib.ingame_python.typeclasses.EventRoom"
+        self.handler.add_event(path, "zz_dummy", [], "Dummy event.", None, None)
+        try:
+            names = self.handler.get_sorted_event_names(self.room1)
+            self.assertEqual(names[-1], "zz_dummy")
+        finally:
+            del self.handler.ndb.events[path]["zz_dummy"]
+            self.handler.ndb.sorted_events = {}
+
+        self.assertNotIn("zz_dummy", self.handler.get_sorted_event_names(self.room1))
+
     def test_add_validation(self):
         """Add a callback while needing validation."""
         author = self.char1
@@ -318,6 +337,75 @@ class TestCmdCallback(CommandTest):
         details = self.call(CmdCallback(), "out = traverse 1")
         self.assertEqual(details.splitlines()[-1], "pass")
 
+    def test_help(self):
+        """Test the help text with different rights."""
+        cmd = CmdCallback()
+        text = cmd.get_help(self.char1, None)
+        self.assertIn("@call/accept", text)
+        self.assertIn("validate callbacks", text)
+
+        # char2 isn't a validator and shouldn't see the accept switch
+        text = cmd.get_help(self.char2, None)
+        self.assertIn("@call/add", text)
+        self.assertNotIn("@call/accept", text)
+        self.assertNotIn("validate callbacks", text)
+
+    def test_perm_cache(self):
+        """Test that cached permission checks follow permission changes."""
+        with patch("evennia.contrib.ingame_python.commands.time.time") as mock_time:
+            mock_time.return_value = 1000
+            self.assertTrue(_cached_check(self.char1, _VALIDATOR_LOCK))
+
+            # Quelling is seen right away, and only the lowest permission is used
+            self.char1.permissions.remove("Developer")
+            self.account.attributes.add("_quell", True)
+            self.assertFalse(_cached_check(self.char1, _VALIDATOR_LOCK))
+            self.account.attributes.remove("_quell")
+            self.assertTrue(_cached_check(self.char1, _VALIDATOR_LOCK))
+
+            # Another account puppeting the character gets a fresh check
+            self.char1.account = self.account2
+            self.assertFalse(_cached_check(self.char1, _VALIDATOR_LOCK))
+            self.char1.account = self.account
+
+            # Unpuppeting forgets the cached checks
+            self.account.permissions.remove("Developer")
+            self.char1.at_post_unpuppet(self.account)
+            self.assertFalse(_cached_check(self.char1, _VALIDATOR_LOCK))
+
+    def test_perm_cache_ttl(self):
+        """Test that revoked permissions are seen once the cache expires."""
+        with patch("evennia.contrib.ingame_python.commands.time.time") as mock_time:
+            mock_time.return_value = 1000
+            self.assertTrue(_cached_check(self.char1, _VALIDATOR_LOCK))
+
+            # Still cached right after the permission is revoked
+            self.account.permissions.remove("Developer")
+            mock_time.return_value = 1000 + PERM_CACHE_TTL - 1
+            self.assertTrue(_cached_check(self.char1, _VALIDATOR_LOCK))
+
+            # The cached result expired
+            mock_time.return_value = 1000 + PERM_CACHE_TTL
+            self.assertFalse(_cached_check(self.char1, _VALIDATOR_LOCK))
+
+    def test_stopped_handler(self):
+        """Test the command once the handler was killed or deleted."""
+        events = self.handler.ndb.events
+        self.call(CmdCallback(), "out", "Callback name")
+        self.handler.stop(kill=True)
+        self.call(CmdCallback(), "out", "The event handler is not running")
+
+        # Deleting the script without stopping it
+        self.handler = create_script("evennia.contrib.ingame_python.scripts.EventHandler")
+        self.handler.ndb.events = events
+        self.call(CmdCallback(), "out", "Callback name")
+        self.handler.delete()
+        self.call(CmdCallback(), "out", "The event handler is not running")
+
+        # Restart a handler for tearDown
+        self.handler = create_script("evennia.contrib.ingame_python.scripts.EventHandler")
+        self.handler.ndb.events = events
+
     def test_add(self):
         """Test to add an callback."""
         self.call(CmdCallback(), "/add out = traverse")
@@ -410,6 +410,25 @@ class EventCharacter(DefaultCharacter):
 
         super().at_pre_unpuppet()
 
+    def at_post_unpuppet(self, account, session=None, **kwargs):
+        """
+        Called just after the Account successfully disconnected from
+        this object, severing all connections.
+
+        Args:
+            account (Account): The account object that just disconnected
+                from this object.
+            session (Session): Session id controlling the connection that
+                just disconnected.
+            **kwargs (dict): Arbitrary, optional arguments for users
+                overriding the call (unused by default).
+
+        """
+        # Forget the permission checks cached by the @call command
+        self.ndb._callback_perm_cache = None
+
+        super().at_post_unpuppet(account, session=session, **kwargs)
+
     def at_before_say(self, message, **kwargs):
         """
         Before the object says something.